@@ -1,160 +1,302 @@
 import streamlit as st
-import base64
+import io
+import json
 import requests
 import os
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter, Retry
 from dotenv import load_dotenv
 
+from pdf_render import (
+    IMAGE_QUALITY_ZOOM,
+    get_render_params,
+    make_thumbnail,
+    pdf_to_images,
+    process_image,
+)
+
+# pybase64 encodes with SIMD (AVX2/SSSE3) loops, several times faster on
+# the multi-MB image payloads; stdlib base64 is the fallback
+try:
+    from pybase64 import b64encode as _b64encode
+except Exception:
+    from base64 import b64encode as _b64encode
+
+# orjson emits UTF-8 bytes directly and is markedly faster on string-heavy
+# payloads; stdlib json is the fallback
+try:
+    import orjson
+
+    def _json_bytes(obj):
+        """Serialize obj to JSON bytes"""
+        return orjson.dumps(obj)
+except Exception:
+    def _json_bytes(obj):
+        """Serialize obj to JSON bytes"""
+        return json.dumps(obj).encode('utf-8')
+
 # Load environment variables
 load_dotenv()
 
 # Get API key from environment variable
 api_key = os.getenv("OPENAI_API_KEY")
 
+# One persistent HTTPS session; keep-alive skips the TCP+TLS handshake
+# that a fresh requests.post pays on every chat turn. Connect-level
+# failures retry with a short backoff before surfacing to the UI
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=4,
+    max_retries=Retry(total=2, backoff_factor=0.3)
+))
+# Static headers set once on the session instead of per call
+_session.headers.update({
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {api_key}"
+})
+
 def encode_image(image_bytes):
-    """Encode image bytes to base64 string"""
-    return base64.b64encode(image_bytes).decode('utf-8')
+    """Encode image bytes (or a BytesIO) to a base64 string"""
+    if isinstance(image_bytes, io.BytesIO):
+        # getbuffer() is a zero-copy view; getvalue() copies the whole buffer
+        image_bytes = image_bytes.getbuffer()
+    # base64 output is pure ASCII, so skip the UTF-8 decoder
+    return _b64encode(image_bytes).decode('ascii')
 
-def analyze_images(images, messages):
-    """Analyze images with chat history context"""
-    if not images:
-        return "Please upload at least one image."
-    
-    # Initialize API messages with system message
-    api_messages = [
-        {
-            "role": "system",
-            "content": "You are an AI assistant analyzing images and engaging in conversation about them."
-        }
-    ]
-    
-    # Add the first message with images
-    first_content = [
-        {
-            "type": "text",
-            "text": messages[0]["content"]
-        }
-    ]
-    
-    # Add all images to the first content
-    for img in images:
-        base64_image = encode_image(img.getvalue())
-        first_content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_image}"
-            }
-        })
-    
-    # Add first message with images
-    api_messages.append({
-        "role": "user",
-        "content": first_content
+# Static JSON fragments of the chat request, built once at import; only the
+# user text, chat history and image base64 vary per call
+_BODY_PRELUDE = (
+    b'"messages":['
+    + _json_bytes({
+        "role": "system",
+        "content": "You are an AI assistant analyzing images and engaging in conversation about them."
     })
-    
-    # Add subsequent messages from chat history
-    for message in messages[1:]:
-        api_messages.append({
+    + b',{"role":"user","content":['
+)
+_IMAGE_PREFIX = b',{"type":"image_url","image_url":{"url":"data:image/jpeg;base64,'
+_IMAGE_SUFFIX = b'"}}'
+
+# Older turns rarely inform the answer but inflate upload bytes and input
+# tokens every call; the first (image-bearing) message is always kept
+MAX_HISTORY_MESSAGES = 10
+
+def _build_request_body(images, messages, stream=False):
+    """Serialize the chat payload, splicing image base64 straight into the body
+
+    Images arrive either as base64 strings precomputed at upload time
+    (the common case - no per-turn encode at all) or as BytesIO, which is
+    chunk-encoded directly into the body buffer so no standalone base64
+    string is ever built for it.
+    """
+    body = io.BytesIO()
+    body.write(b'{"model":"gpt-4o","max_tokens":5000,')
+    if stream:
+        body.write(b'"stream":true,')
+    body.write(_BODY_PRELUDE)
+    body.write(_json_bytes({"type": "text", "text": messages[0]["content"]}))
+    for img in images:
+        body.write(_IMAGE_PREFIX)
+        if isinstance(img, str):
+            # Base64 precomputed at upload time; just splice it in
+            body.write(img.encode('ascii'))
+        else:
+            img.seek(0)
+            while True:
+                # Multiple of 3 bytes, so no padding appears mid-stream
+                chunk = img.read(57 * 1024)
+                if not chunk:
+                    break
+                body.write(_b64encode(chunk))
+        body.write(_IMAGE_SUFFIX)
+    body.write(b']}')
+    # Most recent turns from chat history, capped so long conversations
+    # don't grow the payload (and token bill) without bound
+    for message in messages[max(1, len(messages) - MAX_HISTORY_MESSAGES):]:
+        body.write(b',')
+        body.write(_json_bytes({
             "role": message["role"],
             "content": message["content"]
-        })
-    
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
-    
-    payload = {
-        "model": "gpt-4o",
-        "messages": api_messages,
-        "max_tokens": 5000
-    }
-    # print(api_messages)
-    
+        }))
+    body.write(b']}')
+    return body
+
+def stream_analysis(images, messages):
+    """Stream the assistant reply for the images and chat history
+
+    Yields content deltas as the API produces them, so the UI shows text
+    at time-to-first-token instead of blocking on the full completion.
+    Errors are yielded as a final text chunk.
+    """
+    if not images:
+        yield "Please upload at least one image."
+        return
+
+    body = _build_request_body(images, messages, stream=True)
+
     try:
-        response = requests.post(
+        with _session.post(
             "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=payload
-        )
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
+            data=body.getbuffer(),
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            # SSE frames look like "data: {json}" with a [DONE] sentinel
+            for line in response.iter_lines():
+                if not line.startswith(b'data: '):
+                    continue
+                data = line[6:]
+                if data == b'[DONE]':
+                    break
+                choices = json.loads(data).get("choices")
+                if choices:
+                    content = choices[0].get("delta", {}).get("content")
+                    if content:
+                        yield content
     except requests.exceptions.RequestException as e:
-        return f"Error making request to OpenAI API: {str(e)}"
-    except KeyError as e:
-        return f"Error parsing API response: {str(e)}"
+        yield f"Error making request to OpenAI API: {str(e)}"
+    except (KeyError, ValueError) as e:
+        yield f"Error parsing API response: {str(e)}"
+
+@st.fragment
+def render_sidebar_thumbs(thumbs):
+    """Sidebar thumbnail grid
+
+    A fragment, so chat turns and other whole-app reruns don't re-push
+    every preview to the frontend; the grid only re-executes on its own
+    reruns or when its caller runs again with new uploads.
+    """
+    st.write("### Uploaded Images")
+    for idx, thumb in enumerate(thumbs):
+        st.image(thumb, caption=f"Image {idx + 1}", use_column_width=True)
 
 def initialize_session_state():
     """Initialize session state variables"""
     if "messages" not in st.session_state:
         st.session_state.messages = []
-    if "uploaded_files" not in st.session_state:
-        st.session_state.uploaded_files = None
+    if "processed_images" not in st.session_state:
+        st.session_state.processed_images = None
+    if "processed_b64" not in st.session_state:
+        st.session_state.processed_b64 = None
+    if "processed_thumbs" not in st.session_state:
+        st.session_state.processed_thumbs = None
+    if "upload_key" not in st.session_state:
+        st.session_state.upload_key = None
 
 def main():
     st.title("Multi-Image Analysis ")
-    
+
     # Initialize session state
     initialize_session_state()
-    
+
     # Sidebar for file upload
     with st.sidebar:
         st.header("Upload Images")
         uploaded_files = st.file_uploader(
-            "Choose images to analyze",
-            type=["jpg", "jpeg", "png"],
+            "Choose images or PDFs to analyze",
+            type=["jpg", "jpeg", "png", "pdf"],
             accept_multiple_files=True
         )
-        
+
+        quality = st.selectbox("Image Quality", list(IMAGE_QUALITY_ZOOM))
+        grayscale = st.checkbox(
+            "Grayscale PDF pages (OCR)",
+            help="Renders PDF pages in grayscale: ~3x smaller payloads, "
+                 "faster conversion. Good for text extraction prompts."
+        )
+
         if uploaded_files:
-            st.session_state.uploaded_files = uploaded_files
-            st.write("### Uploaded Images")
-            for idx, image in enumerate(uploaded_files):
-                st.image(image, caption=f"Image {idx + 1}", use_column_width=True)
-    
+            # Cheap signature of the upload set and render settings; when
+            # it matches the previous rerun the session lists are reused
+            # as-is instead of re-wrapping and re-encoding every page
+            upload_key = (
+                tuple((f.name, f.size) for f in uploaded_files),
+                quality,
+                grayscale,
+            )
+
+            def convert_upload(uploaded_file):
+                # getvalue() copies the whole upload buffer; read it once
+                raw = uploaded_file.getvalue()
+                if uploaded_file.name.lower().endswith(".pdf"):
+                    zoom_factor, pages_per_image, jpeg_quality = \
+                        get_render_params(quality)
+                    # Render at the target resolution in one MuPDF step;
+                    # no second resize happens downstream
+                    return pdf_to_images(
+                        raw,
+                        zoom_factor=zoom_factor,
+                        pages_per_image=pages_per_image,
+                        grayscale=grayscale,
+                        jpeg_quality=jpeg_quality
+                    )
+                return [process_image(raw, quality)]
+
+            if st.session_state.upload_key != upload_key:
+                # Convert uploads concurrently. Threads rather than
+                # processes: rasterization runs in C with the GIL released
+                # anyway, and a process pool would pay pickling and bypass
+                # st.cache_data
+                with ThreadPoolExecutor(
+                        max_workers=min(4, len(uploaded_files))) as executor:
+                    results = list(executor.map(convert_upload, uploaded_files))
+
+                processed_images = []
+                processed_b64 = []
+                processed_thumbs = []
+                for pages in results:
+                    for page in pages:
+                        processed_images.append(io.BytesIO(page))
+                        # Encode once here; every chat turn reuses the string
+                        processed_b64.append(encode_image(page))
+                        processed_thumbs.append(make_thumbnail(page))
+                st.session_state.processed_images = processed_images
+                st.session_state.processed_b64 = processed_b64
+                st.session_state.processed_thumbs = processed_thumbs
+                st.session_state.upload_key = upload_key
+            render_sidebar_thumbs(st.session_state.processed_thumbs)
+
     # Main chat interface
     st.write("""
-    Upload images using the sidebar and start a conversation about them. 
+    Upload images or PDFs using the sidebar and start a conversation about them.
     The AI will maintain context of the conversation while analyzing the images.
     """)
-    
+
     # Display chat messages
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
             st.write(message["content"])
-    
+
     # Chat input
     if prompt := st.chat_input("Ask about the images..."):
-        if not st.session_state.uploaded_files:
+        if not st.session_state.processed_images:
             st.error("Please upload at least one image first.")
             return
-        
+
         if not api_key:
             st.error("OpenAI API key not found. Please check your .env file.")
             return
-        
+
         # Add user message to chat history
         st.session_state.messages.append({"role": "user", "content": prompt})
-        
+
         # Display user message
         with st.chat_message("user"):
             st.write(prompt)
-        
-        # Get AI response
+
+        # Stream the AI response as it arrives
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                response = analyze_images(
-                    st.session_state.uploaded_files,
-                    st.session_state.messages
-                )
-                st.write(response)
-                
-                # Add assistant response to chat history
-                st.session_state.messages.append({"role": "assistant", "content": response})
-    
+            response = st.write_stream(stream_analysis(
+                st.session_state.processed_b64,
+                st.session_state.messages
+            ))
+
+            # Add assistant response to chat history
+            st.session_state.messages.append({"role": "assistant", "content": response})
+
     # Add a button to clear chat history
     if st.button("Clear Chat History"):
         st.session_state.messages = []
         st.rerun()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()